@@ -0,0 +1,65 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Compiled kernels for the FOFE encoding, only importable when numba
+is installed.
+"""
+
+from numba import njit, prange  # pylint: disable=import-error
+
+
+@njit(cache=True, parallel=True)
+def fofe_kernel(
+        indices,
+        offsets,
+        lengths,
+        powers,
+        n_symbols,
+        bidirectional,
+        out):
+    """
+    Accumulate the FOFE encoding of each peptide into a row of `out`.
+    Peptides are encoded in parallel since each one only writes to its
+    own row.
+
+    Parameters
+    ----------
+    indices : array of int
+        Token indices of all peptides concatenated together
+
+    offsets : array of int
+        Start of each peptide in `indices`
+
+    lengths : array of int
+        Length of each peptide
+
+    powers : array of float
+        Precomputed powers of the forgetting factor, powers[k] = alpha ** k
+
+    n_symbols : int
+        Number of tokens in the encoder's alphabet
+
+    bidirectional : bool
+        Also accumulate a backward pass into out[:, n_symbols:]
+
+    out : 2D array of float
+        Zero-initialized output array
+    """
+    for i in prange(len(lengths)):  # pylint: disable=not-an-iterable
+        start = offsets[i]
+        l = lengths[i]
+        for j in range(l):
+            aa_idx = indices[start + j]
+            out[i, aa_idx] += powers[l - j - 1]
+            if bidirectional:
+                out[i, n_symbols + aa_idx] += powers[j]
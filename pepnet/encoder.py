@@ -22,6 +22,12 @@ from pepdata.amino_acid_alphabet import (
 from pepdata.pmbec import pmbec_matrix
 from pepdata.blosum import blosum62_matrix
 
+try:
+    from ._fofe_numba import fofe_kernel
+    _NUMBA_AVAILABLE = True
+except ImportError:
+    _NUMBA_AVAILABLE = False
+
 
 class Encoder(Serializable):
     """
@@ -67,6 +73,15 @@ class Encoder(Serializable):
         """
         self._tokens_to_names = OrderedDict()
         self._index_dict = {}
+        # index to assign to the next token added to this encoder
+        self._next_index = 0
+        # lookup table from the ASCII code of each token to its index,
+        # unknown characters are marked with -1. Indices are stored as int32
+        # since that's the dtype of the Keras inputs they get fed into.
+        self._lut = -np.ones(128, dtype="int32")
+        # per-token feature tables for one-hot and BLOSUM/PMBEC encodings,
+        # built on first use and cleared whenever a token is added
+        self._feature_table_cache = {}
 
         self.amino_acid_alphabet = amino_acid_alphabet
         self.variable_length_sequences = variable_length_sequences
@@ -88,11 +103,21 @@ class Encoder(Serializable):
             self._add_token(aa.letter, aa.full_name)
 
     def _add_token(self, token, name):
+        """
+        Add a single character token to the alphabet. Tokens must be ASCII
+        since they're encoded through a 128-entry lookup table indexed by
+        character code.
+        """
         assert len(token) == 1, "Invalid token '%s'" % (token,)
         assert token not in self._index_dict
         assert token not in self._tokens_to_names
-        self._index_dict[token] = len(self._index_dict)
+        assert ord(token) < 128, "Non-ASCII token '%s'" % (token,)
+        index = self._next_index
+        self._next_index += 1
+        self._index_dict[token] = index
+        self._lut[ord(token)] = index
         self._tokens_to_names[token] = name
+        self._feature_table_cache.clear()
 
     def prepare_sequences(self, peptides, padded_peptide_length=None):
         """
@@ -100,21 +125,17 @@ class Encoder(Serializable):
         if padded_peptide_length is provided then pad each peptide to
         be the same length using the gap token '-'.
         """
-        if self.add_start_tokens:
-            peptides = ["^" + p for p in peptides]
-            if padded_peptide_length:
-                padded_peptide_length += 1
-
-        if self.add_stop_tokens:
-            peptides = [p + "$" for p in peptides]
-            if padded_peptide_length:
-                padded_peptide_length += 1
+        prefix = "^" if self.add_start_tokens else ""
+        suffix = "$" if self.add_stop_tokens else ""
 
         if padded_peptide_length:
-            peptides = [
-                p + "-" * (padded_peptide_length - len(p))
+            padded_peptide_length += len(prefix) + len(suffix)
+            return [
+                (prefix + p + suffix).ljust(padded_peptide_length, "-")
                 for p in peptides
             ]
+        elif prefix or suffix:
+            return [prefix + p + suffix for p in peptides]
         return peptides
 
     @property
@@ -143,6 +164,9 @@ class Encoder(Serializable):
         return self._tokens_to_names[k]
 
     def __setitem__(self, k, v):
+        """
+        Add token k (a single ASCII character) with name v.
+        """
         self._add_token(k, v)
 
     def __len__(self):
@@ -152,45 +176,103 @@ class Encoder(Serializable):
             self,
             peptides,
             max_peptide_length=None):
+        """
+        Returns an array of peptide lengths and the length that all
+        peptides will be padded to.
+        """
         require_instance(peptides, (list, tuple, np.ndarray))
+        lengths = np.fromiter(
+            (len(p) for p in peptides), dtype=np.int32, count=len(peptides))
+        max_observed_length = int(lengths.max())
         if max_peptide_length is None:
-            max_peptide_length = max(len(p) for p in peptides)
+            max_peptide_length = max_observed_length
 
         if self.variable_length_sequences:
-            max_observed_length = max(len(p) for p in peptides)
             if max_observed_length > max_peptide_length:
-                example = [p for p in peptides if len(p) == max_observed_length][0]
+                example = peptides[int(np.argmax(lengths))]
                 raise ValueError(
                     "Peptide(s) of length %d when max = %d (example '%s')" % (
                         max_observed_length,
                         max_peptide_length,
                         example))
-        elif any(len(p) != max_peptide_length for p in peptides):
-            example = [p for p in peptides if len(p) != max_peptide_length][0]
-            raise ValueError("Expected all peptides to have length %d, '%s' has length %d" % (
-                max_peptide_length,
-                example,
-                len(example)))
-        return max_peptide_length
+        else:
+            wrong_length = np.flatnonzero(lengths != max_peptide_length)[:1]
+            if len(wrong_length) > 0:
+                example = peptides[int(wrong_length[0])]
+                raise ValueError(
+                    "Expected all peptides to have length %d, '%s' has length %d" % (
+                        max_peptide_length,
+                        example,
+                        len(example)))
+        return lengths, max_peptide_length
 
     def _validate_and_prepare_peptides(self, peptides, max_peptide_length=None):
-        max_peptide_length = self._validate_peptide_lengths(
+        lengths, max_peptide_length = self._validate_peptide_lengths(
             peptides, max_peptide_length)
         peptides = self.prepare_sequences(peptides)
-        # did we add start tokens to each sequence?
-        max_peptide_length += self.add_start_tokens
-        # did we add stop tokens to each sequence?
-        max_peptide_length += self.add_stop_tokens
-        return peptides, max_peptide_length
+        # did we add start and/or stop tokens to each sequence?
+        n_added_tokens = int(self.add_start_tokens) + int(self.add_stop_tokens)
+        lengths += n_added_tokens
+        max_peptide_length += n_added_tokens
+        return peptides, lengths, max_peptide_length
+
+    def _lookup_indices(self, peptide_bytes):
+        """
+        Map an array of ASCII codes to token indices, raising an error
+        if any character isn't part of this encoder's alphabet.
+        """
+        indices = self._lut[peptide_bytes]
+        if (indices < 0).any():
+            unknown = set(
+                chr(c) for c in np.asarray(peptide_bytes)[indices < 0].flat)
+            raise ValueError("Unknown token(s): %s" % (
+                ", ".join("'%s'" % c for c in sorted(unknown)),))
+        return indices
+
+    def _peptides_to_byte_matrix(self, peptides, max_peptide_length):
+        """
+        Pad already prepared peptides to max_peptide_length with the gap
+        token '-' and return a (n_peptides, max_peptide_length) uint8 array
+        of their ASCII codes, built from a single bytes buffer.
+        """
+        padded = "".join(p.ljust(max_peptide_length, "-") for p in peptides)
+        return np.frombuffer(
+            padded.encode("ascii"),
+            dtype=np.uint8).reshape((len(peptides), max_peptide_length))
+
+    def _peptides_to_flat_bytes(self, peptides):
+        """
+        Concatenate already prepared peptides of varying lengths into a
+        single uint8 array of ASCII codes.
+
+        Returns the array along with the offset and length of each peptide.
+        """
+        lengths = np.fromiter(
+            (len(p) for p in peptides), dtype=np.int64, count=len(peptides))
+        offsets = np.cumsum(lengths) - lengths
+        flat_bytes = np.frombuffer(
+            "".join(peptides).encode("ascii"), dtype=np.uint8)
+        return flat_bytes, offsets, lengths
+
+    def _padded_index_array(self, peptides, max_peptide_length):
+        """
+        Pad already prepared peptides to max_peptide_length and return
+        a (n_peptides, max_peptide_length) array of their token indices.
+        """
+        # we're expecting the token '-' to have index 0 so it's
+        # OK to pad the end of each shorter sequence with it
+        return self._lookup_indices(
+            self._peptides_to_byte_matrix(peptides, max_peptide_length))
 
     def encode_index_lists(self, peptides):
         # don't try to do length validation since we're allowed to have
         # multiple peptide lengths
         peptides = self.prepare_sequences(peptides)
-        index_dict = self.index_dict
+        flat_bytes, offsets, lengths = self._peptides_to_flat_bytes(peptides)
+        flat_indices = self._lookup_indices(flat_bytes).tolist()
         return [
-            [index_dict[amino_acid] for amino_acid in peptide]
-            for peptide in peptides
+            flat_indices[offset:offset + length]
+            for (offset, length) in zip(offsets, lengths)
         ]
 
     def encode_index_array(
@@ -200,76 +282,161 @@ class Encoder(Serializable):
         """
         Encode a set of equal length peptides as a matrix of their
         amino acid indices.
+
+        Returns int32 array of shape (n_peptides, max_peptide_length),
+        where the gap token '-' (index 0) pads the end of shorter sequences.
         """
         assert not self.add_normalized_centrality
         assert not self.add_normalized_position
-        peptides, max_peptide_length = self._validate_and_prepare_peptides(
+        peptides, _, max_peptide_length = self._validate_and_prepare_peptides(
             peptides, max_peptide_length)
-        n_peptides = len(peptides)
-        X_index = np.zeros((n_peptides, max_peptide_length), dtype=int)
-        index_dict = self.index_dict
-        for i, peptide in enumerate(peptides):
-            for j, amino_acid in enumerate(peptide):
-                # we're expecting the token '-' to have index 0 so it's
-                # OK to only loop until the end of the given sequence
-                X_index[i, j] = index_dict[amino_acid]
-        return X_index
-
-    def _add_extra_features(self, X, peptides):
+        return self._padded_index_array(peptides, max_peptide_length)
+
+    @property
+    def _n_extra_features(self):
+        """
+        Number of positional features appended to the representation of
+        each residue.
+        """
+        return (
+            int(self.add_normalized_centrality) +
+            int(self.add_normalized_position))
+
+    def _feature_table(self, key, build_table):
+        """
+        Returns a cached C-contiguous float32 table whose rows are the
+        features of each token, widened with zero columns for positional
+        features so that they can be filled in without stacking a new array.
+        Gathering rows of this table with an index array directly gives
+        a C-contiguous float32 result.
+
+        Parameters
+        ----------
+        key : hashable
+            Identifies the table in this encoder's cache, along with the
+            current number of positional features
+
+        build_table : function
+            Called without arguments to build a (n_symbols, n_features)
+            array on a cache miss
+        """
+        # the positional feature flags can change after construction,
+        # so the width of the table is part of the cache key
+        n_extra = self._n_extra_features
+        key = (key, n_extra)
+        if key not in self._feature_table_cache:
+            feature_table = build_table()
+            n_rows, n_features = feature_table.shape
+            extended_table = np.zeros(
+                (n_rows, n_features + n_extra),
+                dtype="float32")
+            extended_table[:, :n_features] = feature_table
+            self._feature_table_cache[key] = extended_table
+        return self._feature_table_cache[key]
+
+    def _add_extra_features(self, X, lengths):
+        """
+        Fill the last few channels of X in place with the
+        normalized centrality and/or position of each residue.
+        """
         if not self.add_normalized_position and not self.add_normalized_centrality:
             return X
-        lengths = np.array([len(p) for p in peptides])
-        n = len(X)
-        max_length = lengths.max()
-
-        X_centrality = np.zeros((n, max_length), dtype="float32")
-        X_position = np.zeros((n, max_length), dtype="float32")
-        for i, l in enumerate(lengths):
-            center = (l - 1) / 2
-            vec = np.arange(l)
-            X_centrality[i, :l] = np.abs(vec - center) / center
-            X_position[i, :] = vec / l
-        extra_arrays = []
+        lengths = lengths.astype("float32")[:, None]
+        positions = np.arange(X.shape[1], dtype="float32")[None, :]
+        # only fill in positions before the end of each sequence
+        mask = positions < lengths
+        channel = X.shape[2] - self._n_extra_features
         if self.add_normalized_centrality:
-            extra_arrays.append(X_centrality)
+            centers = (lengths - 1) / 2
+            # avoid dividing by zero for sequences of length 1
+            X[:, :, channel] = np.where(
+                mask,
+                np.abs(positions - centers) / np.where(centers > 0, centers, 1),
+                0)
+            channel += 1
         if self.add_normalized_position:
-            extra_arrays.append(X_position)
-        return np.dstack([X] + extra_arrays)
+            X[:, :, channel] = np.where(
+                mask,
+                positions / np.maximum(lengths, 1),
+                0)
+        return X
 
-    def _encode_from_pairwise_properties(
-            self, peptides, max_peptide_length, property_matrix):
-        peptides, max_peptide_length = self._validate_and_prepare_peptides(
-            peptides, max_peptide_length)
-        n_peptides = len(peptides)
-        shape = (n_peptides, max_peptide_length, 20)
-        X = np.zeros(shape, dtype="float32")
-        aa_to_feature_row = {}
+    def _build_pairwise_feature_table(self, property_matrix):
+        """
+        Returns a (n_symbols, n_amino_acids) array whose rows are the
+        features of each token, with zero vectors for the gap, start and
+        stop tokens.
+        """
         alphabet_indices = [
             amino_acid_letter_indices[aa.letter]
             for aa in self.amino_acid_alphabet
         ]
+        table = np.zeros(
+            (len(self.index_dict), len(alphabet_indices)),
+            dtype="float32")
         for aa in self.amino_acid_alphabet:
             aa_idx = amino_acid_letter_indices[aa.letter]
             row = property_matrix[aa_idx, :]
-            row = row[alphabet_indices]
-            aa_to_feature_row[aa.letter] = row
-
-        # add zero vectors for gap, start and stop tokens
-        for token in ["-", "^", "$"]:
-            aa_to_feature_row[token] = np.zeros(
-                len(alphabet_indices), dtype="float32")
-        for i, peptide in enumerate(peptides):
-            for j, amino_acid in enumerate(peptide):
-                X[i, j, :] = aa_to_feature_row[amino_acid]
-        return self._add_extra_features(X, peptides)
+            table[self.index_dict[aa.letter], :] = row[alphabet_indices]
+        return table
+
+    def _onehot_feature_table(self):
+        n_symbols = len(self.index_dict)
+        return self._feature_table(
+            "onehot",
+            lambda: np.eye(n_symbols, dtype="float32"))
+
+    def _encode_from_feature_table(
+            self,
+            peptides,
+            max_peptide_length,
+            feature_table,
+            mask_padding=False):
+        """
+        Encode peptides by gathering the row of feature_table for each token.
+
+        If mask_padding is True then positions past the end of each sequence
+        are left as all zeros rather than encoding the gap token.
+        """
+        peptides, lengths, max_peptide_length = self._validate_and_prepare_peptides(
+            peptides, max_peptide_length)
+        X_index = self._padded_index_array(peptides, max_peptide_length)
+        X = feature_table[X_index]
+        if mask_padding:
+            X[np.arange(max_peptide_length)[None, :] >= lengths[:, None]] = 0
+        return self._add_extra_features(X, lengths)
+
+    def _encode_from_pairwise_properties(
+            self, peptides, max_peptide_length, property_matrix):
+        feature_table = self._feature_table(
+            id(property_matrix),
+            lambda: self._build_pairwise_feature_table(property_matrix))
+        return self._encode_from_feature_table(
+            peptides, max_peptide_length, feature_table)
 
     def encode_pmbec(self, peptides, max_peptide_length=None):
+        """
+        Encode a set of equal length peptides by replacing each amino acid
+        with its row of the PMBEC matrix.
+
+        Returns C-contiguous float32 array of shape
+        (n_peptides, max_peptide_length, n_features), which can be passed
+        directly to model.fit.
+        """
         return self._encode_from_pairwise_properties(
             peptides=peptides,
             max_peptide_length=max_peptide_length,
             property_matrix=pmbec_matrix)
 
     def encode_blosum(self, peptides, max_peptide_length=None):
+        """
+        Encode a set of equal length peptides by replacing each amino acid
+        with its row of the BLOSUM62 matrix.
+
+        Returns C-contiguous float32 array of shape
+        (n_peptides, max_peptide_length, n_features), which can be passed
+        directly to model.fit.
+        """
         return self._encode_from_pairwise_properties(
             peptides=peptides,
             max_peptide_length=max_peptide_length,
@@ -283,16 +450,16 @@ class Encoder(Serializable):
         Encode a set of equal length peptides as a binary matrix,
         where each letter is transformed into a length 20 vector with a single
         element that is 1 (and the others are 0).
+
+        Returns C-contiguous float32 array of shape
+        (n_peptides, max_peptide_length, n_features), which can be passed
+        directly to model.fit.
         """
-        peptides, max_peptide_length = self._validate_and_prepare_peptides(
-            peptides, max_peptide_length)
-        index_dict = self.index_dict
-        n_symbols = len(index_dict)
-        X = np.zeros((len(peptides), max_peptide_length, n_symbols), dtype=bool)
-        for i, peptide in enumerate(peptides):
-            for j, amino_acid in enumerate(peptide):
-                X[i, j, index_dict[amino_acid]] = 1
-        return self._add_extra_features(X, peptides)
+        return self._encode_from_feature_table(
+            peptides,
+            max_peptide_length,
+            self._onehot_feature_table(),
+            mask_padding=self.variable_length_sequences)
 
     def encode_FOFE(self, peptides, alpha=0.7, bidirectional=False):
         """
@@ -311,21 +478,149 @@ class Encoder(Serializable):
             Whether to do both a forward pass and a backward pass over each
             peptide
         """
+        return self._encode_FOFE(peptides, alpha, bidirectional)
+
+    def _encode_FOFE(self, peptides, alpha, bidirectional, powers_cache=None):
+        """
+        FOFE encoding which can reuse a table of precomputed powers of alpha.
+
+        If given, powers_cache is a one-element list holding the table. When
+        the table is too short for the given peptides it's rebuilt and the
+        longer table replaces the one in powers_cache for later calls.
+        """
         # don't try to do length validation since we're allowed to have
         # multiple peptide lengths in a FOFE encoding
         peptides = self.prepare_sequences(peptides)
         n_peptides = len(peptides)
-        index_dict = self.index_dict
-        n_symbols = len(index_dict)
+        n_symbols = len(self.index_dict)
         if bidirectional:
             result = np.zeros((n_peptides, 2 * n_symbols), dtype=float)
         else:
             result = np.zeros((n_peptides, n_symbols), dtype=float)
-        for i, p in enumerate(peptides):
-            l = len(p)
-            for j, amino_acid in enumerate(p):
-                aa_idx = index_dict[amino_acid]
-                result[i, aa_idx] += alpha ** (l - j - 1)
-                if bidirectional:
-                    result[i, n_symbols + aa_idx] += alpha ** j
+        if n_peptides == 0:
+            return result
+        flat_bytes, offsets, lengths = self._peptides_to_flat_bytes(peptides)
+        flat_indices = self._lookup_indices(flat_bytes)
+        # powers[k] = alpha ** k, so we don't need to exponentiate per residue
+        powers = powers_cache[0] if powers_cache else None
+        if powers is None or len(powers) < lengths.max():
+            powers = alpha ** np.arange(lengths.max(), dtype=np.float64)
+            if powers_cache is not None:
+                powers_cache[:] = [powers]
+        if _NUMBA_AVAILABLE:
+            fofe_kernel(
+                flat_indices,
+                offsets,
+                lengths,
+                powers,
+                n_symbols,
+                bidirectional,
+                result)
+            return result
+        # without numba, scatter-add the contribution of every residue at once
+        rows = np.repeat(np.arange(n_peptides), lengths)
+        peptide_lengths = np.repeat(lengths, lengths)
+        # position of each residue within its peptide
+        positions = np.arange(len(flat_indices)) - np.repeat(offsets, lengths)
+        np.add.at(
+            result,
+            (rows, flat_indices),
+            powers[peptide_lengths - positions - 1])
+        if bidirectional:
+            np.add.at(
+                result,
+                (rows, n_symbols + flat_indices),
+                powers[positions])
         return result
+
+    def _compile_byte_matrix(self, max_peptide_length):
+        """
+        Returns a function which validates peptides against a fixed
+        max_peptide_length, adds start/stop tokens and pads them with the gap
+        token in a single pass. The function returns a uint8 array of ASCII
+        codes along with the length of each sequence (including start/stop
+        tokens).
+
+        The start/stop token settings are fixed when this is called.
+        """
+        prefix = "^" if self.add_start_tokens else ""
+        suffix = "$" if self.add_stop_tokens else ""
+        n_added_tokens = len(prefix) + len(suffix)
+        padded_length = max_peptide_length + n_added_tokens
+
+        def to_byte_matrix(peptides):
+            lengths, _ = self._validate_peptide_lengths(
+                peptides, max_peptide_length)
+            padded = "".join(
+                (prefix + p + suffix).ljust(padded_length, "-")
+                for p in peptides)
+            byte_matrix = np.frombuffer(
+                padded.encode("ascii"),
+                dtype=np.uint8).reshape((len(peptides), padded_length))
+            return byte_matrix, lengths + n_added_tokens
+        return to_byte_matrix
+
+    def compile_index(self, max_peptide_length):
+        """
+        Returns a function which encodes a list of peptides the same way as
+        encode_index_array with the given max_peptide_length. Useful in
+        training loops which repeatedly encode batches of the same length.
+
+        Start/stop tokens and the padded length are fixed when this is
+        called, so peptides are converted straight into a padded byte matrix
+        without going through prepare_sequences.
+        """
+        assert not self.add_normalized_centrality
+        assert not self.add_normalized_position
+        to_byte_matrix = self._compile_byte_matrix(max_peptide_length)
+
+        def encode(peptides):
+            byte_matrix, _ = to_byte_matrix(peptides)
+            return self._lookup_indices(byte_matrix)
+        return encode
+
+    def compile_onehot(self, max_peptide_length):
+        """
+        Returns a function which encodes a list of peptides the same way as
+        encode_onehot with the given max_peptide_length.
+
+        Start/stop tokens, the padded length and the grid of positions used
+        to mask padding are fixed when this is called. The one-hot feature
+        table is looked up from the encoder's cache on every call, so tokens
+        added afterwards are still encoded correctly.
+        """
+        to_byte_matrix = self._compile_byte_matrix(max_peptide_length)
+        mask_padding = self.variable_length_sequences
+        positions = np.arange(
+            max_peptide_length +
+            int(self.add_start_tokens) +
+            int(self.add_stop_tokens))[None, :]
+
+        def encode(peptides):
+            byte_matrix, lengths = to_byte_matrix(peptides)
+            X = self._onehot_feature_table()[self._lookup_indices(byte_matrix)]
+            if mask_padding:
+                # positions past the end of each sequence are left as all
+                # zeros rather than one-hot encoding the gap token
+                X[positions >= lengths[:, None]] = 0
+            return self._add_extra_features(X, lengths)
+        return encode
+
+    def compile_FOFE(self, max_peptide_length, alpha=0.7, bidirectional=False):
+        """
+        Returns a function which encodes a list of peptides the same way as
+        encode_FOFE, with powers of alpha precomputed for peptides up to
+        max_peptide_length. Longer peptides are still encoded correctly, the
+        first batch containing them grows the table for all later calls.
+        """
+        max_length = (
+            max_peptide_length +
+            int(self.add_start_tokens) +
+            int(self.add_stop_tokens))
+        # kept in a list so that encode can replace it with a longer table
+        powers_cache = [alpha ** np.arange(max_length, dtype=np.float64)]
+
+        def encode(peptides):
+            return self._encode_FOFE(
+                peptides, alpha, bidirectional, powers_cache=powers_cache)
+        return encode
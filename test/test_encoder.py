@@ -1,5 +1,7 @@
 from pepnet.encoder import Encoder
-from nose.tools import eq_
+import pepnet.encoder
+from nose.plugins.skip import SkipTest
+from nose.tools import eq_, raises
 import numpy as np
 
 def test_encoder_index_lists():
@@ -42,6 +44,18 @@ def test_encoder_index_array():
     assert (X == expected).all()
 
 
+@raises(ValueError)
+def test_encoder_index_array_unknown_token():
+    encoder = Encoder()
+    encoder.encode_index_array(["SXS"])
+
+
+@raises(AssertionError)
+def test_encoder_non_ascii_token():
+    encoder = Encoder()
+    encoder[u"\u00e9"] = "Modified E"
+
+
 def test_encoder_FOFE():
     # turn off the gap character '-' used for ends of shorter sequences
     encoder = Encoder(variable_length_sequences=False)
@@ -54,6 +68,35 @@ def test_encoder_FOFE_bidirectional():
     x = encoder.encode_FOFE(["AAA", "SSS", "SASA"], bidirectional=True)
     eq_(x.shape, (3, 40))
 
+def test_encoder_FOFE_values():
+    encoder = Encoder(variable_length_sequences=False)
+    S_idx = encoder.index_dict["S"]
+    A_idx = encoder.index_dict["A"]
+    x = encoder.encode_FOFE(["SAA", "S"], alpha=0.5, bidirectional=True)
+    assert np.allclose(x[0, [S_idx, A_idx]], [0.25, 1.5])
+    assert np.allclose(x[0, [20 + S_idx, 20 + A_idx]], [1.0, 0.75])
+    assert np.allclose(x[1, [S_idx, 20 + S_idx]], [1.0, 1.0])
+    eq_(x.sum(), 0.25 + 1.5 + 1.0 + 0.75 + 2.0)
+
+def _encode_FOFE_with_numba(use_numba, peptides):
+    original = pepnet.encoder._NUMBA_AVAILABLE
+    pepnet.encoder._NUMBA_AVAILABLE = use_numba
+    try:
+        encoder = Encoder(add_start_tokens=True, add_stop_tokens=True)
+        return encoder.encode_FOFE(peptides, alpha=0.7, bidirectional=True)
+    finally:
+        pepnet.encoder._NUMBA_AVAILABLE = original
+
+def test_encoder_FOFE_numba_kernel_matches_numpy_fallback():
+    try:
+        import numba  # pylint: disable=import-error,unused-variable
+    except ImportError:
+        raise SkipTest("numba not installed")
+    peptides = ["SIINFEKL", "AAA", "", "SASAS", "GLCTLVAML"]
+    assert np.allclose(
+        _encode_FOFE_with_numba(True, peptides),
+        _encode_FOFE_with_numba(False, peptides))
+
 def test_encoder_blosum():
     encoder = Encoder(variable_length_sequences=False)
     x = encoder.encode_blosum(["AAA", "SSS", "EEE"])
@@ -69,6 +112,12 @@ def test_encoder_onehot():
     x = encoder.encode_onehot(["AAA", "SSS", "EEE"])
     eq_(x.shape, (3, 3, 20))
 
+def test_encoder_onehot_contiguous_float32():
+    encoder = Encoder()
+    x = encoder.encode_onehot(["AAA", "SS"], max_peptide_length=4)
+    eq_(x.dtype, np.float32)
+    assert x.flags["C_CONTIGUOUS"]
+
 def test_encoder_blosum_with_positional_features():
     encoder = Encoder(
         variable_length_sequences=False,
@@ -93,3 +142,64 @@ def test_encoder_onehot_with_positional_features():
     x = encoder.encode_onehot(["AAA", "SSS", "EEE"])
     eq_(x.shape, (3, 3, 22))
 
+
+def test_encoder_onehot_positional_features_variable_length():
+    encoder = Encoder(
+        add_normalized_position=True,
+        add_normalized_centrality=True)
+    x = encoder.encode_onehot(["SIS", "SI"], max_peptide_length=3)
+    eq_(x.shape, (2, 3, 23))
+    assert np.allclose(x[:, :, -2], [[1, 0, 1], [1, 1, 0]])
+    assert np.allclose(x[:, :, -1], [[0, 1.0 / 3, 2.0 / 3], [0, 0.5, 0]])
+    # padding past the end of the shorter sequence stays all zeros
+    assert not x[1, 2].any()
+
+def test_encoder_onehot_after_adding_token():
+    encoder = Encoder()
+    eq_(encoder.encode_onehot(["SIS"]).shape, (1, 3, 21))
+    encoder["X"] = "Unknown"
+    x = encoder.encode_onehot(["SXS"])
+    eq_(x.shape, (1, 3, 22))
+    assert x[0, 1, encoder.index_dict["X"]]
+
+def test_encoder_compiled_functions_match_encode():
+    encoder = Encoder(add_start_tokens=True)
+    peptides = ["SIINFEKL", "SIINF", "GLC"]
+    assert (
+        encoder.compile_index(8)(peptides) ==
+        encoder.encode_index_array(peptides, max_peptide_length=8)).all()
+    assert (
+        encoder.compile_onehot(8)(peptides) ==
+        encoder.encode_onehot(peptides, max_peptide_length=8)).all()
+    assert np.allclose(
+        encoder.compile_FOFE(4, alpha=0.5, bidirectional=True)(peptides),
+        encoder.encode_FOFE(peptides, alpha=0.5, bidirectional=True))
+
+def test_encoder_blosum_after_enabling_positional_features():
+    encoder = Encoder(variable_length_sequences=False)
+    x = encoder.encode_blosum(["AAA", "SSS"])
+    encoder.add_normalized_position = True
+    x_with_position = encoder.encode_blosum(["AAA", "SSS"])
+    eq_(x_with_position.shape, (2, 3, 21))
+    assert (x_with_position[:, :, :20] == x).all()
+
+def test_encoder_compile_onehot_after_adding_token():
+    encoder = Encoder()
+    encode = encoder.compile_onehot(4)
+    encoder["X"] = "Unknown"
+    x = encode(["SXS", "XX"])
+    eq_(x.shape, (2, 4, 22))
+    assert (x == encoder.encode_onehot(["SXS", "XX"], max_peptide_length=4)).all()
+
+@raises(AssertionError)
+def test_encoder_compile_index_with_positional_features():
+    encoder = Encoder(add_normalized_position=True)
+    encoder.compile_index(9)
+
+def test_encoder_compile_FOFE_longer_than_max_length():
+    encoder = Encoder()
+    encode = encoder.compile_FOFE(2, alpha=0.5)
+    for peptides in [["SIINFEKL", "GLC"], ["SI"], ["SIINFEKLSIINFEKL"]]:
+        assert np.allclose(
+            encode(peptides),
+            encoder.encode_FOFE(peptides, alpha=0.5))